@@ -18,11 +18,13 @@ The file implements Residual MLPs, Patched Decoder layers and PAX ML models.
 """
 
 import dataclasses
+import functools
+import math
 from typing import Optional, Tuple
 
-import einshape as es
 from jax import lax
 import jax.numpy as jnp
+import numpy as np
 from praxis import base_layer
 from praxis import base_model
 from praxis import layers
@@ -63,26 +65,49 @@ _TOLERANCE = 1e-7
 
 
 def _shift_padded_seq(mask: JTensor, seq: JTensor) -> JTensor:
-  """Shifts rows of seq based on the first 0 in each row of the mask."""
+  """Shifts rows of seq based on the first 0 in each row of the mask.
+
+  A seq with a leading dimension of 1 is shared by all the rows of the mask.
+  """
   num = seq.shape[1]
 
   # Find the index of the first 0 in each row of the mask
   first_zero_idx = jnp.argmin(mask, axis=1)
 
-  # Create a range array for indexing
-  idx_range = jnp.arange(num)
+  # Gather every row at its own shifted indices in a single op, B x N.
+  shifted_idx = (jnp.arange(num)[None, :] - first_zero_idx[:, None]) % num
+  if seq.shape[0] == 1:
+    return jnp.take(seq[0], shifted_idx, axis=0)
+  if seq.ndim == 3:
+    shifted_idx = shifted_idx[:, :, None]
 
-  def shift_row(carry, x):
-    seq_row, shift = x
-    shifted_idx = (idx_range - shift) % num
-    shifted_row = seq_row[shifted_idx]
-    return carry, shifted_row
+  return jnp.take_along_axis(seq, shifted_idx, axis=1)
 
-  # Use lax.scan to shift each row of seq based on the corresponding
-  # first_zero_idx.
-  _, shifted_seq = lax.scan(shift_row, None, (seq, first_zero_idx))
 
-  return shifted_seq
+@functools.lru_cache(maxsize=None)
+def _sinusoidal_position_table(
+    seq_length: int,
+    embedding_dims: int,
+    min_timescale: int,
+    max_timescale: int,
+) -> np.ndarray:
+  """Returns the [1, seq_length, embedding_dims] sinusoidal position table.
+
+  Matches `layers.PositionalEmbedding`, but is computed once per shape on the
+  host so that it enters the traced graph as a constant.
+  """
+  num_timescales = embedding_dims // 2
+  log_timescale_increment = math.log(
+      float(max_timescale) / float(min_timescale)
+  ) / max(num_timescales - 1, 1)
+  inv_timescales = min_timescale * np.exp(
+      np.arange(num_timescales, dtype=np.float32) * -log_timescale_increment
+  ).astype(np.float32)
+  position = np.arange(seq_length, dtype=np.float32)
+  scaled_time = position[:, np.newaxis] * inv_timescales[np.newaxis, :]
+  signal = np.concatenate([np.sin(scaled_time), np.cos(scaled_time)], axis=1)
+  signal = np.pad(signal, [[0, 0], [0, np.mod(embedding_dims, 2)]])
+  return signal[np.newaxis, :, :].astype(np.float32)
 
 
 class ResidualBlock(base_layer.BaseLayer):
@@ -97,6 +122,11 @@ class ResidualBlock(base_layer.BaseLayer):
     dropout_tpl: config for dropout.
     ln_tpl: config for layer norm.
     act_tpl: config for activation in hidden layer.
+    inference_dtype: opt-in compute dtype of the feedforward layers in eval
+      mode, e.g. jnp.bfloat16. This is not a bandwidth saving: the weights are
+      still stored and read in their own dtype, then cast on every call.
+    identity_residual: whether to use the inputs as residual instead of a
+      projection of them. Requires input_dims == output_dims.
   """
 
   input_dims: int = 0
@@ -107,8 +137,20 @@ class ResidualBlock(base_layer.BaseLayer):
   dropout_tpl: LayerTpl = template_field(stochastics.Dropout)
   ln_tpl: LayerTpl = template_field(normalizations.LayerNorm)
   act_tpl: LayerTpl = template_field(activations.Swish)
+  inference_dtype: Optional[jnp.dtype] = None
+  identity_residual: bool = False
 
   def setup(self):
+    if self.identity_residual and self.input_dims != self.output_dims:
+      raise ValueError(
+          "identity_residual requires input_dims == output_dims:"
+          f" {self.input_dims} != {self.output_dims}"
+      )
+    # The feedforward layers otherwise inherit the fprop_dtype of the block.
+    ff_kwargs = {}
+    if self.do_eval and self.inference_dtype is not None:
+      ff_kwargs["fprop_dtype"] = self.inference_dtype
+
     lnorm_tpl = self.ln_tpl.clone()
     lnorm_tpl.dim = self.output_dims
     self.create_child("ln_layer", lnorm_tpl)
@@ -124,6 +166,7 @@ class ResidualBlock(base_layer.BaseLayer):
             input_dims=self.input_dims,
             output_dims=self.hidden_dims,
             activation_tpl=self.act_tpl.clone(),
+            **ff_kwargs,
         ),
     )
 
@@ -134,78 +177,86 @@ class ResidualBlock(base_layer.BaseLayer):
             input_dims=self.hidden_dims,
             output_dims=self.output_dims,
             activation_tpl=pax_fiddle.Config(activations.Identity),
+            **ff_kwargs,
         ),
     )
 
-    self.create_child(
-        "residual_layer",
-        pax_fiddle.Config(
-            linears.FeedForward,
-            input_dims=self.input_dims,
-            output_dims=self.output_dims,
-            activation_tpl=pax_fiddle.Config(activations.Identity),
-        ),
-    )
+    if not self.identity_residual:
+      self.create_child(
+          "residual_layer",
+          pax_fiddle.Config(
+              linears.FeedForward,
+              input_dims=self.input_dims,
+              output_dims=self.output_dims,
+              activation_tpl=pax_fiddle.Config(activations.Identity),
+              **ff_kwargs,
+          ),
+      )
 
   def __call__(self, inputs: JTensor) -> JTensor:
-    hidden = self.hidden_layer(inputs)
+    use_inference_dtype = self.do_eval and self.inference_dtype is not None
+    ff_inputs = inputs
+    if use_inference_dtype:
+      ff_inputs = inputs.astype(self.inference_dtype)
+    hidden = self.hidden_layer(ff_inputs)
     output = self.output_layer(hidden)
     output = self.dropout(output)
-    residual = self.residual_layer(inputs)
+    if self.identity_residual:
+      residual = inputs
+    else:
+      residual = self.residual_layer(ff_inputs)
+    output = output + residual
+    if use_inference_dtype:
+      output = output.astype(inputs.dtype)
     if self.layer_norm:
-      return self.ln_layer(output + residual)
+      return self.ln_layer(output)
     else:
-      return output + residual
+      return output
 
 
-def _masked_mean_std(
-    inputs: JTensor, padding: JTensor
+def _masked_mean_var(
+    inputs: JTensor, mask: JTensor
 ) -> Tuple[JTensor, JTensor]:
-  """Calculates mean and standard deviation of arr across axis 1.
+  """Calculates mean and variance of arr across axis 1.
 
-  It should exclude values where pad is 1.
+  It should exclude values where mask is 0, i.e. the padded ones.
 
   Args:
     inputs: A JAX array of shape [b, n, p].
-    padding: A JAX array of shape [b, n, p] with values 0 or 1.
+    mask: A JAX array of shape [b, n, p] with values 0 or 1, i.e. 1 - padding.
 
   Returns:
-    A tuple containing the mean and standard deviation of arr. We return the
+    A tuple containing the mean and variance of arr. We return the
     statistics of the first patch with more than three non-padded values.
   """
-  # Selecting the first pad with more than 3 unpadded values.
-  pad_sum = jnp.sum(1 - padding, axis=2)
+  # Per patch number of valid elements, masked sum and squared sum, B x N.
+  num_valid_elements = jnp.sum(mask, axis=2)
+  masked_sum = jnp.sum(inputs * mask, axis=2)
+  masked_squared_sum = jnp.sum((inputs * mask) ** 2, axis=2)
 
+  # Selecting the first pad with more than 3 unpadded values.
   def _get_patch_index(arr: JTensor):
     indices = jnp.argmax(arr >= 3, axis=1)
     row_sum = (arr >= 3).sum(axis=1)
     return jnp.where(row_sum == 0, arr.shape[1] - 1, indices)
 
-  patch_indices = _get_patch_index(pad_sum)
-  bidxs = jnp.arange(inputs.shape[0])
-
-  arr = inputs[bidxs, patch_indices, :]
-  pad = padding[bidxs, patch_indices, :]
-
-  # Create a mask where P is 0
-  mask = 1 - pad
-
-  # Calculate the number of valid elements
-  num_valid_elements = jnp.sum(mask, axis=1)
+  patch_indices = _get_patch_index(num_valid_elements)[:, None]
 
+  num_valid_elements = jnp.take_along_axis(
+      num_valid_elements, patch_indices, axis=1
+  )[:, 0]
   num_valid_elements = jnp.where(num_valid_elements == 0, 1, num_valid_elements)
+  masked_sum = jnp.take_along_axis(masked_sum, patch_indices, axis=1)[:, 0]
+  masked_squared_sum = jnp.take_along_axis(
+      masked_squared_sum, patch_indices, axis=1
+  )[:, 0]
 
-  # Calculate the masked sum and squared sum of M
-  masked_sum = jnp.sum(arr * mask, axis=1)
-  masked_squared_sum = jnp.sum((arr * mask) ** 2, axis=1)
-
-  # Calculate the masked mean and standard deviation
+  # Calculate the masked mean and variance
   masked_mean = masked_sum / num_valid_elements
   masked_var = masked_squared_sum / num_valid_elements - masked_mean**2
   masked_var = jnp.where(masked_var < 0.0, 0.0, masked_var)
-  masked_std = jnp.sqrt(masked_var)
 
-  return masked_mean, masked_std
+  return masked_mean, masked_var
 
 
 def _create_quantiles() -> list[float]:
@@ -298,25 +349,23 @@ class PatchedTimeSeriesDecoder(base_layer.BaseLayer):
     self.stacked_transformer_layer.transform_decode_state(transform_fn)
 
   def _forward_transform(
-      self, inputs: JTensor, patched_pads: JTensor
+      self, inputs: JTensor, inv_pads: JTensor
   ) -> Tuple[JTensor, Tuple[JTensor, JTensor]]:
-    """Input is of shape [B, N, P]."""
-    mu, sigma = _masked_mean_std(inputs, patched_pads)
-    sigma = jnp.where(sigma < _TOLERANCE, 1.0, sigma)
-    # Normalize each patch.
-    outputs = (inputs - mu[:, None, None]) / sigma[:, None, None]
-    outputs = jnp.where(
-        jnp.abs(inputs - PAD_VAL) < _TOLERANCE, PAD_VAL, outputs
+    """Input is of shape [B, N, P], padded entries of the output are zeros.
+
+    `inv_pads` is 1 - padding, i.e. 1 for the non-padded entries.
+    """
+    mu, var = _masked_mean_var(inputs, inv_pads)
+    inv_sigma = jnp.where(var < _TOLERANCE**2, 1.0, lax.rsqrt(var))
+    sigma = 1.0 / inv_sigma
+    # Normalize each patch and mask out the padded entries in the same pass.
+    outputs = (
+        (inputs - mu[:, None, None])
+        * inv_sigma[:, None, None]
+        * inv_pads
     )
     return outputs, (mu, sigma)
 
-  def _reverse_transform(
-      self, outputs: JTensor, stats: Tuple[JTensor, JTensor]
-  ) -> JTensor:
-    """Output is of shape [B, N, P, Q]."""
-    mu, sigma = stats
-    return outputs * sigma[:, None, None, None] + mu[:, None, None, None]
-
   def _preprocess_input(
       self,
       input_ts: JTensor,
@@ -325,34 +374,38 @@ class PatchedTimeSeriesDecoder(base_layer.BaseLayer):
   ) -> Tuple[JTensor, JTensor, Optional[Tuple[JTensor, JTensor]], JTensor]:
     """Preprocess input for stacked transformer."""
     # Reshape into patches.
-    patched_inputs = es.jax_einshape("b(np)->bnp", input_ts, p=self.patch_len)
-    patched_pads = es.jax_einshape(
-        "b(np)->bnp", input_padding, p=self.patch_len
+    patched_inputs = input_ts.reshape(input_ts.shape[0], -1, self.patch_len)
+    patched_pads = input_padding.reshape(
+        input_padding.shape[0], -1, self.patch_len
     )
     patched_inputs = jnp.where(
         jnp.abs(patched_pads - 1.0) < _TOLERANCE, 0.0, patched_inputs
     )
-    patched_pads = jnp.where(
-        jnp.abs(patched_inputs - PAD_VAL) < _TOLERANCE, 1, patched_pads
-    )
-    patched_inputs, stats = self._forward_transform(
-        patched_inputs, patched_pads
-    )
+    # Float32 values around PAD_VAL are 128 apart, so an exact match is as
+    # permissive as any tolerance below that.
+    patched_pads = jnp.where(patched_inputs == PAD_VAL, 1, patched_pads)
+    inv_pads = 1.0 - patched_pads
+    patched_inputs, stats = self._forward_transform(patched_inputs, inv_pads)
 
     # B x N x D
-    patched_inputs = patched_inputs * (1.0 - patched_pads)
     concat_inputs = jnp.concatenate([patched_inputs, patched_pads], axis=-1)
     model_input = self.input_ff_layer(concat_inputs)
     # A patch should not be padded even if there is at least one zero.
     patched_padding = jnp.min(patched_pads, axis=-1)
 
     if pos_emb is None:
-      position_emb = self.position_emb(seq_length=model_input.shape[1])
+      position_emb = jnp.asarray(
+          _sinusoidal_position_table(
+              model_input.shape[1],
+              self.position_emb.embedding_dims,
+              self.position_emb.min_timescale,
+              self.position_emb.max_timescale,
+          ),
+          dtype=self.position_emb.fprop_dtype,
+      )
     else:
       position_emb = pos_emb
     if self.do_eval:
-      if position_emb.shape[0] != model_input.shape[0]:
-        position_emb = jnp.repeat(position_emb, model_input.shape[0], axis=0)
       position_emb = _shift_padded_seq(patched_padding, position_emb)
     model_input += position_emb
 
@@ -367,10 +420,12 @@ class PatchedTimeSeriesDecoder(base_layer.BaseLayer):
     """Postprocess output of stacked transformer."""
     # B x N x (H.Q)
     output_ts = self.horizon_ff_layer(model_output)
-    output_ts = es.jax_einshape(
-        "bn(hq)->bnhq", output_ts, q=num_outputs, h=self.horizon_len
+    output_ts = output_ts.reshape(
+        *output_ts.shape[:2], self.horizon_len, num_outputs
     )
-    return self._reverse_transform(output_ts, stats)
+    # Reverse the input normalization, B x N x H x Q.
+    mu, sigma = stats
+    return output_ts * sigma[:, None, None, None] + mu[:, None, None, None]
 
   def __call__(self, inputs: NestedMap) -> NestedMap:
     """PatchTST call.
@@ -394,9 +449,8 @@ class PatchedTimeSeriesDecoder(base_layer.BaseLayer):
     )
     if self.use_freq:
       freq = inputs[_FREQ].astype(jnp.int32)
-      f_emb = self.freq_emb(freq)  # B x 1 x D
-      f_emb = jnp.repeat(f_emb, model_input.shape[1], axis=1)
-      model_input += f_emb
+      # B x 1 x D, broadcast over the N patches.
+      model_input += self.freq_emb(freq)
     model_output = self.stacked_transformer_layer(model_input, patched_padding)
 
     output_ts = self._postprocess_output(model_output, num_outputs, stats)
@@ -414,6 +468,11 @@ class PatchedTimeSeriesDecoder(base_layer.BaseLayer):
   ) -> tuple[JTensor, JTensor]:
     """Auto-regressive decoding without caching.
 
+    Keys and values of earlier steps are not reusable in general: once the
+    context window slides past `max_len`, each step renormalizes its inputs
+    with the statistics of its own first valid patch and shifts the position
+    embeddings accordingly, so every step reruns the full stacked transformer.
+
     Args:
       inputs: input time-series and paddings. Time-series shape B x C, padding
         shape shape B x (C + H) where H is the prediction length.
@@ -433,56 +492,133 @@ class PatchedTimeSeriesDecoder(base_layer.BaseLayer):
       the forecastable context length, i.e. context_len - (first) patch_len.
     """
     final_out = inputs[_INPUT_TS]
-    context_len = final_out.shape[1]
+    batch_size, context_len = final_out.shape
     paddings = inputs[_INPUT_PADDING]
     if self.use_freq:
       freq = inputs[_FREQ].astype(jnp.int32)
     else:
-      freq = jnp.zeros([final_out.shape[0], 1], dtype=jnp.int32)
-    full_outputs = []
-    if paddings.shape[1] != final_out.shape[1] + horizon_len:
+      freq = jnp.zeros([batch_size, 1], dtype=jnp.int32)
+    if paddings.shape[1] != context_len + horizon_len:
       raise ValueError(
           "Length of paddings must match length of input + horizon_len:"
-          f" {paddings.shape[1]} != {final_out.shape[1]} + {horizon_len}"
+          f" {paddings.shape[1]} != {context_len} + {horizon_len}"
       )
     if output_patch_len is None:
       output_patch_len = self.horizon_len
     num_decode_patches = (
         horizon_len + output_patch_len - 1
     ) // output_patch_len
-    for step_index in range(num_decode_patches):
-      current_padding = paddings[:, 0 : final_out.shape[1]]
-      input_ts = final_out[:, -max_len:]
-      input_padding = current_padding[:, -max_len:]
+
+    # Length of the window of the last step, the longest one. In eval mode,
+    # shorter windows are left padded to it, which changes neither the
+    # normalization statistics nor the position embeddings, as these are
+    # shifted to the first non-padded patch in eval mode only. Otherwise,
+    # windows grow step by step up to it.
+    window_len = min(
+        max_len, context_len + (num_decode_patches - 1) * output_patch_len
+    )
+    left_pad = max(window_len - context_len, 0) if self.do_eval else 0
+    # Static window length of each step. The first step reads the context
+    # without the left padding: the position embeddings of padded patches wrap
+    # around, so their forecasts on the context would change otherwise.
+    step_window_lens = [min(window_len, context_len)] + [
+        min(window_len, left_pad + context_len + step_index * output_patch_len)
+        for step_index in range(1, num_decode_patches)
+    ]
+    # Preallocated buffers holding the context followed by all the decoded
+    # patches, each step writes its new patch in place.
+    ts_buffer = jnp.concatenate(
+        [
+            jnp.zeros([batch_size, left_pad], dtype=final_out.dtype),
+            final_out,
+            jnp.zeros(
+                [batch_size, num_decode_patches * output_patch_len],
+                dtype=final_out.dtype,
+            ),
+        ],
+        axis=1,
+    )
+    padding_buffer = jnp.concatenate(
+        [jnp.ones([batch_size, left_pad], dtype=paddings.dtype), paddings],
+        axis=1,
+    )
+    full_outputs = jnp.zeros(
+        [
+            batch_size,
+            num_decode_patches * output_patch_len,
+            len(self.quantiles) + 1,
+        ],
+        dtype=final_out.dtype,
+    )
+
+    def _decode_step(step_index, step_window_len, ts_buffer, full_outputs):
+      window_end = left_pad + context_len + step_index * output_patch_len
+      window_start = window_end - step_window_len
       model_input = NestedMap(
-          input_ts=input_ts,
-          input_padding=input_padding,
+          input_ts=lax.dynamic_slice_in_dim(
+              ts_buffer, window_start, step_window_len, axis=1
+          ),
+          input_padding=lax.dynamic_slice_in_dim(
+              padding_buffer, window_start, step_window_len, axis=1
+          ),
           freq=freq,
       )
       fprop_outputs = self(model_input)[_OUTPUT_TS]
-      if return_forecast_on_context and step_index == 0:
-        # For the first decodings step, collect the model forecast on the
-        # context except the unavailable first input batch forecast.
-        new_full_ts = fprop_outputs[:, :-1, : self.patch_len, :]
-        new_full_ts = es.jax_einshape("bnph->b(np)h", new_full_ts)
-
-        full_outputs.append(new_full_ts)
-
-      # (full batch, last patch, output_patch_len, index of mean forecast = 0)
-      new_ts = fprop_outputs[:, -1, :output_patch_len, 0]
-      new_full_ts = fprop_outputs[:, -1, :output_patch_len, :]
       # (full batch, last patch, output_patch_len, all output indices)
-      full_outputs.append(new_full_ts)
-      final_out = jnp.concatenate([final_out, new_ts], axis=-1)
+      new_full_ts = fprop_outputs[:, -1, :output_patch_len, :]
+      # The mean forecast (output index 0) is fed back to the next steps.
+      ts_buffer = lax.dynamic_update_slice_in_dim(
+          ts_buffer, new_full_ts[:, :, 0], window_end, axis=1
+      )
+      full_outputs = lax.dynamic_update_slice_in_dim(
+          full_outputs, new_full_ts, step_index * output_patch_len, axis=1
+      )
+      return fprop_outputs, ts_buffer, full_outputs
+
+    def _loop_body(step_index, carry):
+      _, ts_buffer, full_outputs = _decode_step(step_index, window_len, *carry)
+      return ts_buffer, full_outputs
+
+    # The first step runs outside of the loop, so that all the sub-layers are
+    # set up before entering `lax.fori_loop`. So do the following steps as
+    # long as their windows are shorter than `window_len`, which only happens
+    # outside of eval mode. All the remaining steps share one loop body.
+    fprop_outputs, ts_buffer, full_outputs = _decode_step(
+        0, step_window_lens[0], ts_buffer, full_outputs
+    )
+    first_loop_step = 1
+    while (
+        first_loop_step < num_decode_patches
+        and step_window_lens[first_loop_step] < window_len
+    ):
+      _, ts_buffer, full_outputs = _decode_step(
+          first_loop_step,
+          step_window_lens[first_loop_step],
+          ts_buffer,
+          full_outputs,
+      )
+      first_loop_step += 1
+    ts_buffer, full_outputs = lax.fori_loop(
+        first_loop_step,
+        num_decode_patches,
+        _loop_body,
+        (ts_buffer, full_outputs),
+    )
 
     if return_forecast_on_context:
+      # For the first decodings step, collect the model forecast on the
+      # context except the unavailable first input batch forecast.
+      context_full_ts = fprop_outputs[:, :-1, : self.patch_len, :]
+      context_full_ts = context_full_ts.reshape(
+          batch_size, -1, context_full_ts.shape[-1]
+      )
       # `full_outputs` indexing starts at after the first input patch.
-      full_outputs = jnp.concatenate(full_outputs, axis=1)[
+      full_outputs = jnp.concatenate([context_full_ts, full_outputs], axis=1)[
           :, : (context_len - self.patch_len + horizon_len), :
       ]
     else:
       # `full_outputs` indexing starts at the forecast horizon.
-      full_outputs = jnp.concatenate(full_outputs, axis=1)[:, 0:horizon_len, :]
+      full_outputs = full_outputs[:, 0:horizon_len, :]
 
     return (full_outputs[:, :, 0], full_outputs)
 
@@ -523,21 +659,21 @@ class PatchedDecoderFinetuneModel(base_model.BaseModel):
     return self.core_layer(new_input_batch)
 
   def _quantile_loss(
-      self, pred: JTensor, actual: JTensor, quantile: float
+      self, pred: JTensor, actual: JTensor, quantiles: JTensor
   ) -> JTensor:
-    """Calculates quantile loss.
+    """Calculates quantile loss for all quantiles at once.
 
     Args:
-      pred: B x T
-      actual: B x T
-      quantile: quantile at which loss is computed.
+      pred: B x T x Q
+      actual: B x T x 1
+      quantiles: Q quantiles at which loss is computed.
 
     Returns:
-      per coordinate loss.
+      per coordinate and quantile loss.
     """
     dev = actual - pred
-    loss_first = dev * quantile
-    loss_second = -dev * (1.0 - quantile)
+    loss_first = dev * quantiles
+    loss_second = -dev * (1.0 - quantiles)
     return 2 * jnp.where(loss_first >= 0, loss_first, loss_second)
 
   def compute_loss(
@@ -547,8 +683,10 @@ class PatchedDecoderFinetuneModel(base_model.BaseModel):
     actual_ts = input_batch[_TARGET_FUTURE]
     pred_ts = output_ts[:, -1, 0 : actual_ts.shape[1], :]
     loss = jnp.square(pred_ts[:, :, 0] - actual_ts)
-    for i, quantile in enumerate(self.core_layer.quantiles):
-      loss += self._quantile_loss(pred_ts[:, :, i + 1], actual_ts, quantile)
+    quantiles = jnp.asarray(self.core_layer.quantiles, dtype=pred_ts.dtype)
+    loss += self._quantile_loss(
+        pred_ts[:, :, 1:], actual_ts[:, :, None], quantiles
+    ).sum(axis=-1)
     loss = loss.mean()
     loss_weight = jnp.array(1.0, dtype=jnp.float32)
     per_example_out = NestedMap()
@@ -0,0 +1,469 @@
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+from praxis import base_layer
+from praxis import layers
+from praxis import pax_fiddle
+from praxis import py_utils
+from praxis.layers import transformers
+
+from timesfm import patched_decoder
+
+NestedMap = py_utils.NestedMap
+instantiate = base_layer.instantiate
+
+_PATCH_LEN = 4
+_OUTPUT_PATCH_LEN = 8
+_RNGS = {
+    base_layer.PARAMS: jax.random.PRNGKey(1),
+    base_layer.RANDOM: jax.random.PRNGKey(2),
+}
+
+
+def _jax_context(do_eval: bool) -> base_layer.JaxContext:
+    return base_layer.JaxContext.new_context(
+        hparams=base_layer.JaxContext.HParams(do_eval=do_eval)
+    )
+
+
+def _tiny_decoder_config() -> pax_fiddle.Config:
+    return pax_fiddle.Config(
+        patched_decoder.PatchedTimeSeriesDecoder,
+        name="patched_decoder",
+        patch_len=_PATCH_LEN,
+        horizon_len=_OUTPUT_PATCH_LEN,
+        model_dims=16,
+        hidden_dims=16,
+        quantiles=[0.1, 0.5, 0.9],
+        residual_block_tpl=pax_fiddle.Config(patched_decoder.ResidualBlock),
+        stacked_transformer_params_tpl=pax_fiddle.Config(
+            transformers.StackedTransformer,
+            num_heads=2,
+            num_layers=2,
+        ),
+    )
+
+
+def _sample_inputs(
+    batch_size: int, context_len: int, horizon_len: int
+) -> NestedMap:
+    rng = np.random.default_rng(0)
+    input_ts = rng.normal(size=(batch_size, context_len)).cumsum(axis=1)
+    input_padding = np.zeros((batch_size, context_len + horizon_len))
+    # Left pad the first series by one patch.
+    input_ts[0, :_PATCH_LEN] = 0.0
+    input_padding[0, :_PATCH_LEN] = 1.0
+    return NestedMap(
+        input_ts=jnp.asarray(input_ts, dtype=jnp.float32),
+        input_padding=jnp.asarray(input_padding, dtype=jnp.float32),
+        freq=jnp.zeros((batch_size, 1), dtype=jnp.int32),
+    )
+
+
+def _reference_decode(
+    model: patched_decoder.PatchedTimeSeriesDecoder,
+    variables: NestedMap,
+    inputs: NestedMap,
+    horizon_len: int,
+    output_patch_len: int,
+    max_len: int,
+    return_forecast_on_context: bool,
+) -> tuple[jax.Array, jax.Array]:
+    """Auto-regressive decoding with a growing window, one call per step."""
+    final_out = inputs["input_ts"]
+    context_len = final_out.shape[1]
+    paddings = inputs["input_padding"]
+    full_outputs = []
+    num_decode_patches = (
+        horizon_len + output_patch_len - 1
+    ) // output_patch_len
+    for step_index in range(num_decode_patches):
+        current_padding = paddings[:, 0 : final_out.shape[1]]
+        model_input = NestedMap(
+            input_ts=final_out[:, -max_len:],
+            input_padding=current_padding[:, -max_len:],
+            freq=inputs["freq"],
+        )
+        fprop_outputs = model.apply(variables, model_input, rngs=_RNGS)[
+            "output_ts"
+        ]
+        if return_forecast_on_context and step_index == 0:
+            new_full_ts = fprop_outputs[:, :-1, : model.patch_len, :]
+            full_outputs.append(
+                new_full_ts.reshape(
+                    new_full_ts.shape[0], -1, new_full_ts.shape[-1]
+                )
+            )
+        full_outputs.append(fprop_outputs[:, -1, :output_patch_len, :])
+        final_out = jnp.concatenate(
+            [final_out, fprop_outputs[:, -1, :output_patch_len, 0]], axis=-1
+        )
+
+    full_outputs = jnp.concatenate(full_outputs, axis=1)
+    if return_forecast_on_context:
+        full_outputs = full_outputs[
+            :, : (context_len - model.patch_len + horizon_len), :
+        ]
+    else:
+        full_outputs = full_outputs[:, 0:horizon_len, :]
+    return full_outputs[:, :, 0], full_outputs
+
+
+@pytest.mark.parametrize("do_eval", [True, False])
+@pytest.mark.parametrize("return_forecast_on_context", [True, False])
+@pytest.mark.parametrize(
+    "context_len, horizon_len, max_len",
+    [
+        (16, 24, 32),  # context_len < max_len, windows are left padded.
+        (32, 24, 16),  # context_len > max_len, windows slide.
+        (16, 8, 32),  # A single decoding step, the loop runs zero times.
+    ],
+)
+def test_decode_matches_reference(
+    context_len: int,
+    horizon_len: int,
+    max_len: int,
+    return_forecast_on_context: bool,
+    do_eval: bool,
+) -> None:
+    model = instantiate(_tiny_decoder_config())
+    inputs = _sample_inputs(3, context_len, horizon_len)
+    with _jax_context(do_eval):
+        variables = model.init(
+            _RNGS,
+            NestedMap(
+                input_ts=inputs["input_ts"],
+                input_padding=inputs["input_padding"][:, :context_len],
+                freq=inputs["freq"],
+            ),
+        )
+        expected_mean, expected_full = _reference_decode(
+            model,
+            variables,
+            inputs,
+            horizon_len=horizon_len,
+            output_patch_len=_OUTPUT_PATCH_LEN,
+            max_len=max_len,
+            return_forecast_on_context=return_forecast_on_context,
+        )
+        mean, full = model.apply(
+            variables,
+            inputs,
+            horizon_len=horizon_len,
+            output_patch_len=_OUTPUT_PATCH_LEN,
+            max_len=max_len,
+            return_forecast_on_context=return_forecast_on_context,
+            rngs=_RNGS,
+            method=model.decode,
+        )
+
+    assert full.shape == expected_full.shape
+    np.testing.assert_allclose(mean, expected_mean, rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(full, expected_full, rtol=1e-4, atol=1e-4)
+
+
+def _init_block(
+    block: patched_decoder.ResidualBlock, inputs: jax.Array
+) -> NestedMap:
+    with _jax_context(do_eval=False):
+        return block.init(_RNGS, inputs)
+
+
+def test_residual_block_inference_dtype() -> None:
+    block = instantiate(
+        pax_fiddle.Config(
+            patched_decoder.ResidualBlock,
+            name="residual_block",
+            input_dims=8,
+            hidden_dims=16,
+            output_dims=4,
+            inference_dtype=jnp.bfloat16,
+        )
+    )
+    inputs = jax.random.normal(jax.random.PRNGKey(0), (2, 3, 8))
+    variables = _init_block(block, inputs)
+
+    def _hidden(mdl, x):
+        return mdl.hidden_layer(x.astype(jnp.bfloat16))
+
+    outputs = {}
+    for do_eval in (True, False):
+        with _jax_context(do_eval):
+            hidden = block.apply(variables, inputs, method=_hidden)
+            outputs[do_eval] = block.apply(variables, inputs)
+        # Float32 weights promote bfloat16 inputs unless the feedforward
+        # layers run in the inference dtype.
+        assert hidden.dtype == (jnp.bfloat16 if do_eval else jnp.float32)
+        assert outputs[do_eval].dtype == jnp.float32
+
+    assert not np.array_equal(outputs[True], outputs[False])
+    np.testing.assert_allclose(
+        outputs[True], outputs[False], rtol=5e-2, atol=5e-2
+    )
+
+
+@pytest.mark.parametrize("fprop_dtype", [jnp.float32, jnp.bfloat16])
+def test_residual_block_default_dtype_in_eval(fprop_dtype: jnp.dtype) -> None:
+    block = instantiate(
+        pax_fiddle.Config(
+            patched_decoder.ResidualBlock,
+            name="residual_block",
+            input_dims=8,
+            hidden_dims=16,
+            output_dims=4,
+            fprop_dtype=fprop_dtype,
+        )
+    )
+    inputs = jax.random.normal(jax.random.PRNGKey(0), (2, 3, 8))
+    variables = _init_block(block, inputs)
+
+    def _expected(mdl, x):
+        return mdl.output_layer(mdl.hidden_layer(x)) + mdl.residual_layer(x)
+
+    with _jax_context(do_eval=True):
+        eval_outputs = block.apply(variables, inputs)
+        expected = block.apply(variables, inputs, method=_expected)
+    with _jax_context(do_eval=False):
+        train_outputs = block.apply(variables, inputs)
+
+    # Without inference_dtype, float32 inputs are not cast down.
+    np.testing.assert_array_equal(eval_outputs, expected)
+    np.testing.assert_array_equal(eval_outputs, train_outputs)
+
+
+def test_residual_block_identity_residual() -> None:
+    block = instantiate(
+        pax_fiddle.Config(
+            patched_decoder.ResidualBlock,
+            name="residual_block",
+            input_dims=8,
+            hidden_dims=16,
+            output_dims=8,
+            identity_residual=True,
+        )
+    )
+    inputs = jax.random.normal(jax.random.PRNGKey(0), (2, 3, 8))
+    variables = _init_block(block, inputs)
+    assert "residual_layer" not in variables["params"]
+
+    def _expected(mdl, x):
+        return mdl.output_layer(mdl.hidden_layer(x)) + x
+
+    with _jax_context(do_eval=True):
+        outputs = block.apply(variables, inputs)
+        expected = block.apply(variables, inputs, method=_expected)
+    np.testing.assert_allclose(outputs, expected, rtol=1e-6, atol=1e-6)
+
+
+def test_residual_block_identity_residual_requires_equal_dims() -> None:
+    block = instantiate(
+        pax_fiddle.Config(
+            patched_decoder.ResidualBlock,
+            name="residual_block",
+            input_dims=8,
+            hidden_dims=16,
+            output_dims=4,
+            identity_residual=True,
+        )
+    )
+    with pytest.raises(ValueError, match="identity_residual"):
+        _init_block(block, jnp.zeros((2, 3, 8)))
+
+
+@pytest.mark.parametrize("seq_shape", [(4, 6), (4, 6, 3), (1, 6, 3)])
+def test_shift_padded_seq_matches_per_row_roll(seq_shape: tuple[int, ...]) -> None:
+    num = seq_shape[1]
+    # The last row is fully padded, its first 0 is then taken at index 0.
+    first_zero_idx = [0, 2, 5, 0]
+    mask = np.zeros((4, num), dtype=np.float32)
+    for row, first_zero in enumerate(first_zero_idx[:-1]):
+        mask[row, :first_zero] = 1.0
+    mask[-1] = 1.0
+    seq = np.random.default_rng(0).normal(size=seq_shape).astype(np.float32)
+
+    shifted = patched_decoder._shift_padded_seq(
+        jnp.asarray(mask), jnp.asarray(seq)
+    )
+
+    expected = np.stack(
+        [
+            np.roll(seq[row if seq.shape[0] > 1 else 0], shift, axis=0)
+            for row, shift in enumerate(first_zero_idx)
+        ]
+    )
+    np.testing.assert_array_equal(shifted, expected)
+
+
+@pytest.mark.parametrize("embedding_dims", [16, 7])
+def test_sinusoidal_position_table_matches_positional_embedding(
+    embedding_dims: int,
+) -> None:
+    layer = instantiate(
+        pax_fiddle.Config(
+            layers.PositionalEmbedding,
+            name="position_emb",
+            embedding_dims=embedding_dims,
+        )
+    )
+    with _jax_context(do_eval=True):
+        expected = layer.apply({}, seq_length=12)
+
+    table = patched_decoder._sinusoidal_position_table(
+        12, embedding_dims, layer.min_timescale, layer.max_timescale
+    )
+    assert table.shape == expected.shape
+    np.testing.assert_allclose(table, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_masked_mean_var_matches_per_row_stats() -> None:
+    inputs = np.random.default_rng(0).normal(size=(5, 3, 4)).astype(np.float32)
+    mask = np.ones_like(inputs)
+    # A constant series.
+    inputs[1] = 5.0
+    # Padded entries holding PAD_VAL, the first patch has too few values.
+    mask[2, 0, :2] = 0.0
+    mask[2, 1, 0] = 0.0
+    inputs[2][mask[2] == 0] = patched_decoder.PAD_VAL
+    # Mostly padded, no patch has 3 values: the last patch is used.
+    mask[3, :, 1:3] = 0.0
+    # Fully padded.
+    mask[4] = 0.0
+
+    mean, var = patched_decoder._masked_mean_var(
+        jnp.asarray(inputs), jnp.asarray(mask)
+    )
+
+    expected_mean, expected_var = [], []
+    for row_inputs, row_mask in zip(inputs, mask):
+        num_valid = row_mask.sum(axis=1)
+        patch = np.argmax(num_valid >= 3) if (num_valid >= 3).any() else -1
+        values = row_inputs[patch][row_mask[patch] == 1].astype(np.float64)
+        expected_mean.append(values.mean() if values.size else 0.0)
+        expected_var.append(values.var() if values.size else 0.0)
+    np.testing.assert_allclose(mean, expected_mean, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(var, expected_var, rtol=1e-5, atol=1e-5)
+
+
+def test_compute_loss_matches_per_quantile_loop() -> None:
+    model = instantiate(
+        pax_fiddle.Config(
+            patched_decoder.PatchedDecoderFinetuneModel,
+            name="patched_decoder_finetune",
+            core_layer_tpl=_tiny_decoder_config(),
+        )
+    )
+    rng = np.random.default_rng(0)
+    # B x N x horizon_len x (1 + # quantiles), scored on 6 target steps.
+    output_ts = rng.normal(size=(2, 3, _OUTPUT_PATCH_LEN, 4)).astype(np.float32)
+    actual_ts = rng.normal(size=(2, 6)).astype(np.float32)
+    # Ties between forecasts and targets.
+    actual_ts[0, :2] = output_ts[0, -1, :2, 2]
+
+    with _jax_context(do_eval=False):
+        metrics, _ = model.apply(
+            {},
+            NestedMap(output_ts=jnp.asarray(output_ts)),
+            NestedMap(actual_ts=jnp.asarray(actual_ts)),
+            method=model.compute_loss,
+        )
+
+    pred_ts = output_ts[:, -1, :6, :]
+    expected = np.square(pred_ts[:, :, 0] - actual_ts)
+    for i, quantile in enumerate([0.1, 0.5, 0.9]):
+        dev = actual_ts - pred_ts[:, :, i + 1]
+        expected += 2 * np.where(
+            dev * quantile >= 0, dev * quantile, -dev * (1.0 - quantile)
+        )
+    loss, _ = metrics["avg_qloss"]
+    np.testing.assert_allclose(loss, expected.mean(), rtol=1e-6)
+
+
+def test_forward_transform_matches_sqrt_and_divide() -> None:
+    rng = np.random.default_rng(0)
+    inputs = rng.normal(size=(4, 3, _PATCH_LEN)).astype(np.float32)
+    pads = np.zeros_like(inputs)
+    # A constant series, whose sigma falls back to 1.
+    inputs[1] = 3.0
+    # A large scale series.
+    inputs[2] *= 1e3
+    # Left padded by more than one patch.
+    pads[3, 0] = 1.0
+    pads[3, 1, :2] = 1.0
+    inputs[3][pads[3] == 1] = 0.0
+
+    model = instantiate(_tiny_decoder_config())
+    outputs, (mu, sigma) = model.apply(
+        {},
+        jnp.asarray(inputs),
+        jnp.asarray(1.0 - pads),
+        method=lambda mdl, x, inv_pads: mdl._forward_transform(x, inv_pads),
+    )
+
+    expected_mu, expected_sigma = [], []
+    for row_inputs, row_pads in zip(inputs, pads):
+        patch = np.argmax((row_pads == 0).sum(axis=1) >= 3)
+        values = row_inputs[patch][row_pads[patch] == 0].astype(np.float64)
+        std = values.std()
+        expected_mu.append(values.mean())
+        expected_sigma.append(1.0 if std < 1e-7 else std)
+    expected_mu = np.asarray(expected_mu)[:, None, None]
+    expected_sigma = np.asarray(expected_sigma)[:, None, None]
+    expected = (inputs - expected_mu) / expected_sigma * (1.0 - pads)
+    np.testing.assert_allclose(mu, expected_mu[:, 0, 0], rtol=1e-5)
+    np.testing.assert_allclose(sigma, expected_sigma[:, 0, 0], rtol=1e-5)
+    np.testing.assert_allclose(outputs, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_preprocess_input_pads_pad_val_entries() -> None:
+    pad_val = np.float32(patched_decoder.PAD_VAL)
+    input_ts = np.random.default_rng(0).normal(size=(2, 16)).astype(np.float32)
+    input_padding = np.zeros_like(input_ts)
+    # A whole patch and a single entry of PAD_VAL, the latter in the patch
+    # the normalization statistics are taken from.
+    input_ts[0, :_PATCH_LEN] = pad_val
+    input_ts[0, _PATCH_LEN] = pad_val
+    # The nearest float32 values are real values, not padding.
+    input_ts[1, 8] = np.nextafter(pad_val, np.float32(np.inf))
+    input_ts[1, 12] = np.nextafter(pad_val, np.float32(0.0))
+    inputs = NestedMap(
+        input_ts=jnp.asarray(input_ts),
+        input_padding=jnp.asarray(input_padding),
+        freq=jnp.zeros((2, 1), dtype=jnp.int32),
+    )
+
+    model = instantiate(_tiny_decoder_config())
+    with _jax_context(do_eval=True):
+        variables = model.init(_RNGS, inputs)
+        _, patched_padding, (mu, _), patched_inputs = model.apply(
+            variables,
+            inputs["input_ts"],
+            inputs["input_padding"],
+            method=lambda mdl, x, pads: mdl._preprocess_input(x, pads),
+        )
+
+    # Entries within _TOLERANCE of PAD_VAL were padded before, which in
+    # float32 only holds for PAD_VAL itself.
+    pads = np.abs(input_ts - pad_val) < 1e-7
+    pads = pads.reshape(2, -1, _PATCH_LEN)
+    np.testing.assert_array_equal(patched_padding, pads.min(axis=-1))
+    np.testing.assert_array_equal(np.asarray(patched_inputs)[pads], 0.0)
+    assert np.all(np.asarray(patched_inputs)[~pads] != 0.0)
+    np.testing.assert_allclose(
+        mu[0], input_ts[0, _PATCH_LEN + 1 : 2 * _PATCH_LEN].mean(), rtol=1e-5
+    )